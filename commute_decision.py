@@ -3,23 +3,100 @@ import itertools
 
 class Sentence():
 
+    # Whether the sentence can no longer change; only And can grow, through
+    # And.add, so a sentence is frozen when it has no And inside it
+    _frozen = False
+
+    # Number of And.add calls so far that changed a conjunction already read,
+    # which results cached on a sentence that is not frozen must still match
+    _additions = 0
+
+    # Set of symbols and hash, filled in on first use, and _additions at
+    # the time each was computed
+    _symbols = None
+    _symbols_added = None
+    _hash = None
+    _hash_added = None
+
+    def __hash__(self):
+        """Hashes the sentence; subclasses that define __eq__ reuse this."""
+        if self._hash is None or not self._current(self._hash_added):
+            self._hash = self._compute_hash()
+            self._hash_added = Sentence._additions
+        return self._hash
+
+    def _compute_hash(self):
+        """Hashes the sentence from the hashes of its parts."""
+        raise Exception("nothing to hash")
+
+    def _current(self, added):
+        """Checks if a result computed when _additions was added is valid."""
+        return self._frozen or added == Sentence._additions
+
     def evaluate(self, model):
         """Evaluates the logical sentence."""
         raise Exception("nothing to evaluate")
 
+    def truth_table(self, columns, rows):
+        """Returns the truth table of the sentence, one bit per model."""
+        raise Exception("nothing to evaluate")
+
+    def to_cnf(self, idx, definitions=None):
+        """Returns the sentence as a list of clauses of integer literals.
+
+        Distributing disjunction over conjunction can multiply the number
+        of clauses, so the result may grow exponentially with the nesting
+        of the sentence. Given a list of definitions, biconditionals with
+        compound sides instead refer to new symbols, numbered in idx and
+        defined by clauses added to that list; the result together with
+        the definitions is then satisfiable exactly when the sentence is.
+        """
+        raise Exception("nothing to convert")
+
     def formula(self):
         """Returns string formula representing logical sentence."""
         return ""
 
     def symbols(self):
         """Returns a set of all symbols in the logical sentence."""
-        return set()
+        return set(self._symbol_set())
+
+    def _symbol_set(self):
+        """Returns the symbols as a frozenset, cached until an And grows."""
+        if self._symbols is None or not self._current(self._symbols_added):
+            self._symbols = frozenset(self._compute_symbols())
+            self._symbols_added = Sentence._additions
+        return self._symbols
+
+    def _compute_symbols(self):
+        """Collects the symbols of the sentence's parts."""
+        return frozenset()
 
     @classmethod
     def validate(cls, sentence):
         if not isinstance(sentence, Sentence):
             raise TypeError("must be a logical sentence")
 
+    @classmethod
+    def auxiliary(cls, sentence, idx, definitions):
+        """Returns a literal equivalent to sentence under definitions."""
+        if isinstance(sentence, Symbol):
+            return sentence
+        if isinstance(sentence, Not):
+            return Not(cls.auxiliary(sentence.operand, idx, definitions))
+
+        # Define a new symbol the first time a sentence needs one
+        symbol = Symbol(f"<{sentence!r}>")
+        if symbol.name not in idx:
+            idx[symbol.name] = max(idx.values(), default=0) + 1
+            definitions.extend(
+                Or(Not(symbol), sentence).to_cnf(idx, definitions)
+            )
+            definitions.extend(
+                Or(symbol, Not(sentence)).to_cnf(idx, definitions)
+            )
+        return symbol
+
     @classmethod
     def parenthesize(cls, s):
         """Parenthesizes an expression if not already parenthesized."""
@@ -44,13 +121,17 @@ class Sentence():
 
 class Symbol(Sentence):
 
+    _frozen = True
+
     def __init__(self, name):
         self.name = name
 
     def __eq__(self, other):
         return isinstance(other, Symbol) and self.name == other.name
 
-    def __hash__(self):
+    __hash__ = Sentence.__hash__
+
+    def _compute_hash(self):
         return hash(("symbol", self.name))
 
     def __repr__(self):
@@ -62,22 +143,31 @@ class Symbol(Sentence):
         except KeyError:
             raise EvaluationException(f"variable {self.name} not in model")
 
+    def truth_table(self, columns, rows):
+        return columns[self.name]
+
+    def to_cnf(self, idx, definitions=None):
+        return [frozenset([idx[self.name]])]
+
     def formula(self):
         return self.name
 
-    def symbols(self):
-        return {self.name}
+    def _compute_symbols(self):
+        return frozenset([self.name])
 
 
 class Not(Sentence):
     def __init__(self, operand):
         Sentence.validate(operand)
         self.operand = operand
+        self._frozen = operand._frozen
 
     def __eq__(self, other):
         return isinstance(other, Not) and self.operand == other.operand
 
-    def __hash__(self):
+    __hash__ = Sentence.__hash__
+
+    def _compute_hash(self):
         return hash(("not", hash(self.operand)))
 
     def __repr__(self):
@@ -86,23 +176,50 @@ class Not(Sentence):
     def evaluate(self, model):
         return not self.operand.evaluate(model)
 
+    def truth_table(self, columns, rows):
+        return rows ^ self.operand.truth_table(columns, rows)
+
+    def to_cnf(self, idx, definitions=None):
+        operand = self.operand
+
+        # Push negation inward until it only applies to symbols
+        if isinstance(operand, Symbol):
+            return [frozenset([-idx[operand.name]])]
+        if isinstance(operand, Not):
+            return operand.operand.to_cnf(idx, definitions)
+        if isinstance(operand, And):
+            negated = Or(*[Not(conjunct) for conjunct in operand.conjuncts])
+            return negated.to_cnf(idx, definitions)
+        if isinstance(operand, Or):
+            negated = And(*[Not(disjunct) for disjunct in operand.disjuncts])
+            return negated.to_cnf(idx, definitions)
+        if isinstance(operand, Implication):
+            return And(operand.antecedent,
+                       Not(operand.consequent)).to_cnf(idx, definitions)
+        if isinstance(operand, Biconditional):
+            return Biconditional(operand.left,
+                                 Not(operand.right)).to_cnf(idx, definitions)
+        raise Exception("nothing to convert")
+
     def formula(self):
         return "¬" + Sentence.parenthesize(self.operand.formula())
 
-    def symbols(self):
-        return self.operand.symbols()
+    def _compute_symbols(self):
+        return self.operand._symbol_set()
 
 
 class And(Sentence):
     def __init__(self, *conjuncts):
+        self.conjuncts = []
         for conjunct in conjuncts:
-            Sentence.validate(conjunct)
-        self.conjuncts = list(conjuncts)
+            self.add(conjunct)
 
     def __eq__(self, other):
         return isinstance(other, And) and self.conjuncts == other.conjuncts
 
-    def __hash__(self):
+    __hash__ = Sentence.__hash__
+
+    def _compute_hash(self):
         return hash(
             ("and", tuple(hash(conjunct) for conjunct in self.conjuncts))
         )
@@ -115,10 +232,41 @@ class And(Sentence):
 
     def add(self, conjunct):
         Sentence.validate(conjunct)
-        self.conjuncts.append(conjunct)
+
+        # Hoist the conjuncts of a nested conjunction into this one
+        if isinstance(conjunct, And):
+            self.conjuncts.extend(conjunct.conjuncts)
+        else:
+            self.conjuncts.append(conjunct)
+
+        # Once anything has read this conjunction's symbols or hash, they
+        # may be cached in sentences containing it too, so discard them all;
+        # a conjunction still being built has nothing to discard
+        if self._symbols is not None or self._hash is not None:
+            self._symbols = self._hash = None
+            Sentence._additions += 1
 
     def evaluate(self, model):
-        return all(conjunct.evaluate(model) for conjunct in self.conjuncts)
+        conjuncts = self.conjuncts
+        if len(conjuncts) == 2:
+            return (conjuncts[0].evaluate(model)
+                    and conjuncts[1].evaluate(model))
+        for conjunct in conjuncts:
+            if not conjunct.evaluate(model):
+                return False
+        return True
+
+    def truth_table(self, columns, rows):
+        table = rows
+        for conjunct in self.conjuncts:
+            table &= conjunct.truth_table(columns, rows)
+        return table
+
+    def to_cnf(self, idx, definitions=None):
+        clauses = dict()
+        for conjunct in self.conjuncts:
+            clauses.update(dict.fromkeys(conjunct.to_cnf(idx, definitions)))
+        return list(clauses)
 
     def formula(self):
         if len(self.conjuncts) == 1:
@@ -126,20 +274,32 @@ class And(Sentence):
         return " ∧ ".join([Sentence.parenthesize(conjunct.formula())
                            for conjunct in self.conjuncts])
 
-    def symbols(self):
-        return set.union(*[conjunct.symbols() for conjunct in self.conjuncts])
+    def _compute_symbols(self):
+        symbols = set()
+        for conjunct in self.conjuncts:
+            symbols |= conjunct._symbol_set()
+        return symbols
 
 
 class Or(Sentence):
     def __init__(self, *disjuncts):
+        self.disjuncts = []
         for disjunct in disjuncts:
             Sentence.validate(disjunct)
-        self.disjuncts = list(disjuncts)
+
+            # Hoist the disjuncts of a nested disjunction into this one
+            if isinstance(disjunct, Or):
+                self.disjuncts.extend(disjunct.disjuncts)
+            else:
+                self.disjuncts.append(disjunct)
+        self._frozen = all(disjunct._frozen for disjunct in self.disjuncts)
 
     def __eq__(self, other):
         return isinstance(other, Or) and self.disjuncts == other.disjuncts
 
-    def __hash__(self):
+    __hash__ = Sentence.__hash__
+
+    def _compute_hash(self):
         return hash(
             ("or", tuple(hash(disjunct) for disjunct in self.disjuncts))
         )
@@ -149,7 +309,34 @@ class Or(Sentence):
         return f"Or({disjuncts})"
 
     def evaluate(self, model):
-        return any(disjunct.evaluate(model) for disjunct in self.disjuncts)
+        disjuncts = self.disjuncts
+        if len(disjuncts) == 2:
+            return (disjuncts[0].evaluate(model)
+                    or disjuncts[1].evaluate(model))
+        for disjunct in disjuncts:
+            if disjunct.evaluate(model):
+                return True
+        return False
+
+    def truth_table(self, columns, rows):
+        table = 0
+        for disjunct in self.disjuncts:
+            table |= disjunct.truth_table(columns, rows)
+        return table
+
+    def to_cnf(self, idx, definitions=None):
+
+        # Distribute disjunction over the clauses of each disjunct
+        clauses = {frozenset()}
+        for disjunct in self.disjuncts:
+            others = disjunct.to_cnf(idx, definitions)
+            clauses = {clause | other
+                       for clause in clauses
+                       for other in others}
+
+        # Drop clauses that contain both a literal and its negation
+        return [clause for clause in clauses
+                if not any(-literal in clause for literal in clause)]
 
     def formula(self):
         if len(self.disjuncts) == 1:
@@ -157,8 +344,11 @@ class Or(Sentence):
         return " ∨  ".join([Sentence.parenthesize(disjunct.formula())
                             for disjunct in self.disjuncts])
 
-    def symbols(self):
-        return set.union(*[disjunct.symbols() for disjunct in self.disjuncts])
+    def _compute_symbols(self):
+        symbols = set()
+        for disjunct in self.disjuncts:
+            symbols |= disjunct._symbol_set()
+        return symbols
 
 
 class Implication(Sentence):
@@ -167,13 +357,16 @@ class Implication(Sentence):
         Sentence.validate(consequent)
         self.antecedent = antecedent
         self.consequent = consequent
+        self._frozen = antecedent._frozen and consequent._frozen
 
     def __eq__(self, other):
         return (isinstance(other, Implication)
                 and self.antecedent == other.antecedent
                 and self.consequent == other.consequent)
 
-    def __hash__(self):
+    __hash__ = Sentence.__hash__
+
+    def _compute_hash(self):
         return hash(("implies", hash(self.antecedent), hash(self.consequent)))
 
     def __repr__(self):
@@ -183,13 +376,23 @@ class Implication(Sentence):
         return ((not self.antecedent.evaluate(model))
                 or self.consequent.evaluate(model))
 
+    def truth_table(self, columns, rows):
+        antecedent = self.antecedent.truth_table(columns, rows)
+        consequent = self.consequent.truth_table(columns, rows)
+        return (rows ^ antecedent) | consequent
+
+    def to_cnf(self, idx, definitions=None):
+        return Or(Not(self.antecedent),
+                  self.consequent).to_cnf(idx, definitions)
+
     def formula(self):
         antecedent = Sentence.parenthesize(self.antecedent.formula())
         consequent = Sentence.parenthesize(self.consequent.formula())
         return f"{antecedent} => {consequent}"
 
-    def symbols(self):
-        return set.union(self.antecedent.symbols(), self.consequent.symbols())
+    def _compute_symbols(self):
+        return (self.antecedent._symbol_set()
+                | self.consequent._symbol_set())
 
 
 class Biconditional(Sentence):
@@ -198,69 +401,202 @@ class Biconditional(Sentence):
         Sentence.validate(right)
         self.left = left
         self.right = right
+        self._frozen = left._frozen and right._frozen
 
     def __eq__(self, other):
         return (isinstance(other, Biconditional)
                 and self.left == other.left
                 and self.right == other.right)
 
-    def __hash__(self):
+    __hash__ = Sentence.__hash__
+
+    def _compute_hash(self):
         return hash(("biconditional", hash(self.left), hash(self.right)))
 
     def __repr__(self):
         return f"Biconditional({self.left}, {self.right})"
 
     def evaluate(self, model):
-        return ((self.left.evaluate(model)
-                 and self.right.evaluate(model))
-                or (not self.left.evaluate(model)
-                    and not self.right.evaluate(model)))
+        left = self.left.evaluate(model)
+        right = self.right.evaluate(model)
+        return left == right
+
+    def truth_table(self, columns, rows):
+        left = self.left.truth_table(columns, rows)
+        right = self.right.truth_table(columns, rows)
+        return rows ^ (left ^ right)
+
+    def to_cnf(self, idx, definitions=None):
+        left, right = self.left, self.right
+
+        # Stand in a defined symbol for each compound side, so that nested
+        # biconditionals do not double the clauses at every level
+        if definitions is not None:
+            left = Sentence.auxiliary(left, idx, definitions)
+            right = Sentence.auxiliary(right, idx, definitions)
+        return And(Implication(left, right),
+                   Implication(right, left)).to_cnf(idx, definitions)
 
     def formula(self):
-        left = Sentence.parenthesize(str(self.left))
-        right = Sentence.parenthesize(str(self.right))
+        left = Sentence.parenthesize(self.left.formula())
+        right = Sentence.parenthesize(self.right.formula())
         return f"{left} <=> {right}"
 
-    def symbols(self):
-        return set.union(self.left.symbols(), self.right.symbols())
-
-
-def model_check(knowledge, query):
-    """Checks if knowledge base entails query."""
-
-    def check_all(knowledge, query, symbols, model):
-        """Checks if knowledge base entails query, given a particular model."""
-
-        # If model has an assignment for each symbol
-        if not symbols:
-
-            # If knowledge base is true in model, then query must also be true
-            if knowledge.evaluate(model):
-                return query.evaluate(model)
-            return True
+    def _compute_symbols(self):
+        return self.left._symbol_set() | self.right._symbol_set()
+
+
+def truth_table_columns(symbols):
+    """Returns the truth table column of each symbol and the mask of all rows.
+
+    Row m of the table is the model in which the i-th symbol is true exactly
+    when bit i of m is set. Each column packs one row per bit of an integer,
+    so that whole truth tables combine with single bitwise operations.
+    """
+    rows = (1 << (1 << len(symbols))) - 1
+    columns = dict()
+    for i, symbol in enumerate(symbols):
+
+        # Block of 2^i false rows followed by 2^i true rows
+        width = 1 << (i + 1)
+        column = ((1 << (1 << i)) - 1) << (1 << i)
+
+        # Repeat the block until it covers every row
+        while width < (1 << len(symbols)):
+            column |= column << width
+            width <<= 1
+        columns[symbol] = column
+    return columns, rows
+
+
+def dpll(clauses, true, false):
+    """Checks if a list of clauses is satisfiable, extending a model.
+
+    Each clause is a pair of bitmasks of the symbols it contains positively
+    and negatively, and true and false are bitmasks of the symbols already
+    assigned each value.
+    """
+
+    # Model and guessed symbol before each guess whose opposite is untried
+    branches = []
+
+    while True:
+
+        # Collect the unassigned symbols of clauses not yet satisfied, by
+        # the polarity they appear with
+        unit = None
+        positive = negative = 0
+        for pos, neg in clauses:
+            if pos & true or neg & false:
+                continue
+            free = (pos | neg) & ~(true | false)
+
+            # A clause with every literal false can no longer be satisfied,
+            # so try the opposite of the latest guess not yet reversed
+            if not free:
+                if not branches:
+                    return False
+                true, false, bit = branches.pop()
+                false |= bit
+                break
+            if not free & (free - 1):
+                unit = (free & pos, free & neg)
+            positive |= free & pos
+            negative |= free & neg
         else:
 
-            # Choose one of the remaining unused symbols
-            remaining = symbols.copy()
-            p = remaining.pop()
-
-            # Create a model where the symbol is true
-            model_true = model.copy()
-            model_true[p] = True
+            # Every clause satisfied
+            if not positive | negative:
+                return True
+
+            # Assign the symbol of a unit clause, which has no other choice
+            if unit is not None:
+                true |= unit[0]
+                false |= unit[1]
+                continue
+
+            # Assign every symbol that appears with only one polarity
+            if positive ^ negative:
+                true |= positive & ~negative
+                false |= negative & ~positive
+                continue
+
+            # Otherwise guess that a remaining symbol is true
+            bit = positive & -positive
+            branches.append((true, false, bit))
+            true |= bit
+
+
+def find_model(sentence, symbols, model):
+    """Checks if sentence is true in some model extending the given one."""
+
+    # Number each symbol, so that literals are signed integers
+    idx = {symbol: i for i, symbol in enumerate(set(symbols).union(model), 1)}
+
+    # Lower the sentence to bitmasks of each clause's symbols by polarity
+    definitions = []
+    cnf = sentence.to_cnf(idx, definitions)
+    clauses = []
+    for clause in cnf + definitions:
+        pos = neg = 0
+        for literal in clause:
+            if literal > 0:
+                pos |= 1 << literal
+            else:
+                neg |= 1 << -literal
+        clauses.append((pos, neg))
+
+    # Search for a satisfying assignment, starting from model's values
+    true = false = 0
+    for symbol, value in model.items():
+        if value:
+            true |= 1 << idx[symbol]
+        else:
+            false |= 1 << idx[symbol]
+    return dpll(clauses, true, false)
+
+
+def _extract_units(knowledge):
+    """Splits the symbols knowledge states outright from its other rules.
+
+    Returns the forced value of each such symbol, or None if two of them
+    contradict each other, along with the sentence that remains.
+    """
+    if not isinstance(knowledge, And):
+        return dict(), knowledge
+    units = dict()
+    rules = []
+    for conjunct in knowledge.conjuncts:
+        if isinstance(conjunct, Symbol):
+            name, value = conjunct.name, True
+        elif (isinstance(conjunct, Not)
+              and isinstance(conjunct.operand, Symbol)):
+            name, value = conjunct.operand.name, False
+        else:
+            rules.append(conjunct)
+            continue
+        if units.get(name, value) != value:
+            return None, knowledge
+        units[name] = value
+    return units, And(*rules)
 
-            # Create a model where the symbol is false
-            model_false = model.copy()
-            model_false[p] = False
 
-            # Ensure entailment holds in both models
-            return (check_all(knowledge, query, remaining, model_true) and
-                    check_all(knowledge, query, remaining, model_false))
+def model_check(knowledge, query):
+    """Checks if knowledge base entails query."""
 
     # Get all symbols in both knowledge and query
     symbols = set.union(knowledge.symbols(), query.symbols())
 
-    # Check that knowledge entails query
-    return check_all(knowledge, query, symbols, dict())
+    # Fix the symbols that knowledge states outright, rather than search
+    # over them; if those contradict, knowledge entails anything
+    units, knowledge = _extract_units(knowledge)
+    if units is None:
+        return True
+
+    # Knowledge entails query unless some model makes knowledge true and
+    # query false; a single such counterexample settles it
+    return not find_model(And(knowledge, Not(query)),
+                          symbols.difference(units), units)
 
 
 # Define the symbols for conditions
@@ -319,9 +655,33 @@ knowledge.add(
     )
 )
 
+# Truth table of the knowledge base in every model, shared by all scenarios,
+# along with the column of each symbol, the mask of all rows, and the number
+# of rules it was computed from
+knowledge_table = knowledge_columns = all_rows = None
+knowledge_table_rules = None
+
+
+# Function to recompute the knowledge base's truth table after rules are added
+def update_knowledge_table():
+    global knowledge_table, knowledge_columns, all_rows, knowledge_table_rules
+    if knowledge_table_rules == len(knowledge.conjuncts):
+        return
+    knowledge_columns, all_rows = truth_table_columns(
+        sorted(knowledge.symbols())
+    )
+    knowledge_table = knowledge.truth_table(knowledge_columns, all_rows)
+    knowledge_table_rules = len(knowledge.conjuncts)
+
 # Function to perform model checking for a given scenario
 def check_scenario(scenario_conditions, scenario_name):
-    # Create a new knowledge base that includes the conditions
+    # Start from the models of the knowledge base without any conditions
+    update_knowledge_table()
+    table = knowledge_table
+    columns, rows = knowledge_columns, all_rows
+
+    # Also build the knowledge base with the conditions added, to check the
+    # truth table's answers against model_check
     knowledge_scenario = And(knowledge)
     
     # Set of all condition symbols
@@ -334,22 +694,45 @@ def check_scenario(scenario_conditions, scenario_name):
         'RoadConstruction': RoadConstruction
     }
     
-    # Add conditions to the knowledge base
+    # Keep only the models that satisfy the conditions
     for condition_name, condition_symbol in all_conditions.items():
+        column = columns[condition_symbol.name]
         if condition_name in scenario_conditions:
-            # If condition is specified in the scenario, add it as is
+            # If condition is specified in the scenario, keep only the
+            # models where it has the given value
             if scenario_conditions[condition_name]:
+                table &= column
                 knowledge_scenario.add(condition_symbol)
             else:
+                table &= rows ^ column
                 knowledge_scenario.add(Not(condition_symbol))
         else:
-            # If condition is unspecified, explicitly set it to False
+            # If condition is unspecified, keep only the models where it
+            # is False
+            table &= rows ^ column
             knowledge_scenario.add(Not(condition_symbol))
+
+    # If no model satisfies the conditions, every option is vacuously
+    # entailed, so there is nothing to check
+    if not table:
+        assert not find_model(knowledge_scenario,
+                              knowledge_scenario.symbols(), dict())
+        print(f"{scenario_name}: KB unsatisfiable "
+              "(all queries vacuously entailed)")
+        print()
+        return
     
-    # Now, check if the knowledge base entails each commuting option
-    entails_WFH = model_check(knowledge_scenario, WFH)
-    entails_Drive = model_check(knowledge_scenario, Drive)
-    entails_PublicTransport = model_check(knowledge_scenario, PublicTransport)
+    # Now, check if each commuting option is true in every remaining model
+    entails_WFH = not (table & (rows ^ columns[WFH.name]))
+    entails_Drive = not (table & (rows ^ columns[Drive.name]))
+    entails_PublicTransport = not (
+        table & (rows ^ columns[PublicTransport.name])
+    )
+    assert entails_WFH == model_check(knowledge_scenario, WFH)
+    assert entails_Drive == model_check(knowledge_scenario, Drive)
+    assert entails_PublicTransport == model_check(
+        knowledge_scenario, PublicTransport
+    )
     
     # Print the results
     print(f"{scenario_name} entails WFH:", entails_WFH)